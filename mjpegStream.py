@@ -12,10 +12,25 @@ import socketserver
 import io
 import time
 import socket
+import os
+import struct
+import bisect
+import collections
 
 capture=None
+recorder=None
+cameraOutput=None
+captureStop = threading.Event()
 previousMinTime = 0
 
+# (wall clock minus Intan time offset, wall clock of the newest buffer),
+# published as one tuple so readers never see a mismatched pair
+intanAnchor = None
+# (wall clock, offset) of recent waveform buffers; see publishIntanAnchor()
+intanOffsets = collections.deque()
+intanOffsetsLock = threading.Lock()
+previousIntanTimestamp = None
+
 # Declare buffer size for reading from TCP command socket
 COMMAND_BUFFER_SIZE = 1024
 
@@ -30,6 +45,23 @@ HIGH_CUTOFF = 7000
 #Data plot settings
 TIME_RANGE = 20 #seconds
 
+#Camera recording settings
+RECORD_VIDEO = False
+RECORD_DIRECTORY = 'recordings'
+SEGMENT_MAX_BYTES = 256 * 1024 * 1024
+# Frames get no Intan timestamp once the newest waveform buffer is older than
+# this. The anchor only advances while a data.mjpg client is streaming.
+INTAN_ANCHOR_MAX_AGE = 3 #seconds
+# Waveform buffers considered when estimating the wall clock to Intan offset
+INTAN_OFFSET_WINDOW = 30 #seconds
+# cam.mjpg clients give up if the capture thread sends nothing for this long
+CAMERA_FRAME_TIMEOUT = 5 #seconds
+
+# Index entry: frame number (uint32), wall clock (double), Intan timestamp
+# valid flag (bool), Intan timestamp (int64), byte offset into segment
+# (uint64), JPEG length (uint32)
+INDEX_ENTRY = struct.Struct('<Id?qQI')
+
 PAGE="""
 <html>
 <head>
@@ -148,14 +180,17 @@ class CamHandler(server.BaseHTTPRequestHandler):
             self.end_headers()
             while True:
                 try:
-                    rc,img = capture.read()
-                    if not rc:
-                        continue
-                    imgRGB=cv2.cvtColor(img,cv2.COLOR_BGR2RGB)
-                    jpg = Image.fromarray(imgRGB)
-                    tmpFile = io.BytesIO()
-                    jpg.save(tmpFile,'JPEG')
-                    buffer = tmpFile.getvalue()
+                    if cameraOutput is not None:
+                        # Recording: captureFrames() owns the camera
+                        with cameraOutput.condition:
+                            if not cameraOutput.condition.wait(CAMERA_FRAME_TIMEOUT):
+                                break
+                            buffer = cameraOutput.frame
+                    else:
+                        rc,img = capture.read()
+                        if not rc:
+                            continue
+                        buffer = encodeFrame(img)
                     self.wfile.write(b'--jpgboundary\r\n')
                     self.send_header('Content-Type','image/jpeg')
                     self.send_header('Content-Length',str(len(buffer)))
@@ -217,6 +252,218 @@ class CamHandler(server.BaseHTTPRequestHandler):
 class ThreadedHTTPServer(socketserver.ThreadingMixIn, server.HTTPServer):
     """Handle requests in a separate thread."""
 
+def encodeFrame(img):
+    imgRGB=cv2.cvtColor(img,cv2.COLOR_BGR2RGB)
+    jpg = Image.fromarray(imgRGB)
+    tmpFile = io.BytesIO()
+    jpg.save(tmpFile,'JPEG')
+    return tmpFile.getvalue()
+
+class CameraOutput(object):
+    """Latest encoded camera frame, shared by every cam.mjpg client."""
+    def __init__(self):
+        self.frame = None
+        self.condition = threading.Condition()
+
+    def write(self, buffer):
+        with self.condition:
+            self.frame = buffer
+            self.condition.notify_all()
+
+def captureFrames():
+    # Sole reader of the camera while recording: each frame is encoded once,
+    # recorded, then handed to the cam.mjpg clients
+    global recorder
+    while not captureStop.is_set():
+        try:
+            rc,img = capture.read()
+            if not rc:
+                continue
+            wallClock = time.time()
+            buffer = encodeFrame(img)
+        except Exception as e:
+            print('Camera capture failed: ' + str(e))
+            time.sleep(0.1)
+            continue
+        if recorder is not None:
+            try:
+                recorder.write(buffer, wallClock)
+            except Exception as e:
+                # Keep the live stream going if the disk fills up
+                print('Recording stopped: ' + str(e))
+                failedRecorder = recorder
+                recorder = None
+                try:
+                    failedRecorder.close()
+                except OSError:
+                    pass
+        cameraOutput.write(buffer)
+
+class FrameRecorder(object):
+    """Append already-encoded camera JPEGs to segment files with an index.
+
+    Each recorder writes into its own session_YYYYmmdd_HHMMSS subdirectory, so
+    frame numbers and Intan timestamps from separate runs never mix. Each
+    segment_NNNNN.mjpg holds the raw JPEGs back to back, and the matching
+    segment_NNNNN.idx holds one INDEX_ENTRY per frame, so any frame can be
+    read back with a single seek. Known Intan timestamps never decrease
+    within a segment.
+    """
+    def __init__(self, directory, segmentMaxBytes=SEGMENT_MAX_BYTES):
+        sessionName = time.strftime('session_%Y%m%d_%H%M%S')
+        self.directory = os.path.join(directory, sessionName)
+        suffix = 1
+        while os.path.exists(self.directory):
+            self.directory = os.path.join(directory, '%s_%d' % (sessionName, suffix))
+            suffix += 1
+        self.segmentMaxBytes = segmentMaxBytes
+        self.lock = threading.Lock()
+        self.frameNumber = 0
+        self.segmentNumber = -1
+        self.segmentFile = None
+        self.indexFile = None
+        self.lastIntanTimestamp = None
+        self.warnedUnknownTimestamp = False
+        os.makedirs(self.directory)
+        self.openSegment()
+
+    def openSegment(self):
+        self.closeSegment()
+        self.segmentNumber += 1
+        self.lastIntanTimestamp = None
+        name = os.path.join(self.directory, 'segment_%05d' % self.segmentNumber)
+        self.segmentFile = open(name + '.mjpg', 'ab')
+        self.indexFile = open(name + '.idx', 'ab')
+
+    def closeSegment(self):
+        if self.segmentFile is not None:
+            self.segmentFile.close()
+            self.indexFile.close()
+            self.segmentFile = None
+            self.indexFile = None
+
+    def write(self, buffer, wallClock):
+        intanTimestamp = estimateIntanTimestamp(wallClock)
+        with self.lock:
+            if self.segmentFile is None:
+                return
+            if intanTimestamp is None:
+                if not self.warnedUnknownTimestamp:
+                    self.warnedUnknownTimestamp = True
+                    print('Warning: recording camera frames without Intan '
+                          'timestamps; open a data stream page to align them')
+            else:
+                self.warnedUnknownTimestamp = False
+            offset = self.segmentFile.tell()
+            # Start a new segment when full, or when Intan time goes backwards
+            # (acquisition restarted) so each segment stays sorted
+            restarted = (intanTimestamp is not None and self.lastIntanTimestamp is not None
+                         and intanTimestamp < self.lastIntanTimestamp)
+            if offset > 0 and (restarted or offset + len(buffer) > self.segmentMaxBytes):
+                self.openSegment()
+                offset = 0
+            if intanTimestamp is not None:
+                self.lastIntanTimestamp = intanTimestamp
+            self.segmentFile.write(buffer)
+            self.indexFile.write(INDEX_ENTRY.pack(self.frameNumber, wallClock,
+                                                  intanTimestamp is not None,
+                                                  intanTimestamp or 0,
+                                                  offset, len(buffer)))
+            self.segmentFile.flush()
+            self.indexFile.flush()
+            self.frameNumber += 1
+
+    def close(self):
+        with self.lock:
+            self.closeSegment()
+
+def estimateIntanTimestamp(wallClock):
+    # Convert using the wall clock to Intan offset. The anchor only advances
+    # while a data.mjpg client is streaming, so a missing or stale anchor
+    # gives None (unknown) rather than a drifting guess.
+    anchor = intanAnchor
+    if anchor is None:
+        return None
+    offset, receivedWallClock = anchor
+    if wallClock - receivedWallClock > INTAN_ANCHOR_MAX_AGE:
+        return None
+    return int(round((wallClock - offset) / timestep))
+
+def publishIntanAnchor(lastTimestamp, receivedWallClock):
+    # A buffer's arrival time is only an upper bound on when its last sample
+    # was acquired: data queues in the socket whenever the plot loop falls
+    # behind. The least delayed recent buffer gives the smallest offset, so
+    # the minimum over the window is the best estimate.
+    global intanAnchor
+    global previousIntanTimestamp
+    if lastTimestamp is None:
+        return
+    offset = receivedWallClock - lastTimestamp * timestep
+    with intanOffsetsLock:
+        if previousIntanTimestamp is not None and lastTimestamp < previousIntanTimestamp:
+            # Acquisition restarted, earlier offsets no longer apply
+            intanOffsets.clear()
+        previousIntanTimestamp = lastTimestamp
+        intanOffsets.append((receivedWallClock, offset))
+        while intanOffsets[0][0] < receivedWallClock - INTAN_OFFSET_WINDOW:
+            intanOffsets.popleft()
+        intanAnchor = (min(o for w, o in intanOffsets), receivedWallClock)
+
+def readIndex(indexPath):
+    with open(indexPath, 'rb') as indexFile:
+        raw = indexFile.read()
+    # Drop a partially written trailing entry
+    raw = raw[:len(raw) - len(raw) % INDEX_ENTRY.size]
+    return list(INDEX_ENTRY.iter_unpack(raw))
+
+def readSessionIndex(sessionDirectory):
+    """Return [(segment path, Intan timestamps, entries)] for frames with a
+    known Intan timestamp, one item per non-empty segment.
+
+    Pass the result to findFrame() to avoid re-reading it on every lookup.
+    """
+    sessionIndex = []
+    for name in sorted(os.listdir(sessionDirectory)):
+        if not name.endswith('.idx'):
+            continue
+        indexPath = os.path.join(sessionDirectory, name)
+        entries = [entry for entry in readIndex(indexPath) if entry[2]]
+        if entries:
+            timestamps = [entry[3] for entry in entries]
+            sessionIndex.append((indexPath[:-4] + '.mjpg', timestamps, entries))
+    return sessionIndex
+
+def findFrame(sessionDirectory, intanTimestamp, sessionIndex=None):
+    """Return (segment path, index entry) of the frame nearest intanTimestamp.
+
+    Raises ValueError if no frame in the session has a known Intan timestamp.
+    """
+    if sessionIndex is None:
+        sessionIndex = readSessionIndex(sessionDirectory)
+    if not sessionIndex:
+        raise ValueError('No frames with Intan timestamps in ' + sessionDirectory)
+
+    # Pick the segment whose timestamp range is nearest, then bisect in it
+    def rangeDistance(segment):
+        timestamps = segment[1]
+        if intanTimestamp < timestamps[0]:
+            return timestamps[0] - intanTimestamp
+        if intanTimestamp > timestamps[-1]:
+            return intanTimestamp - timestamps[-1]
+        return 0
+    segmentPath, timestamps, entries = min(sessionIndex, key=rangeDistance)
+
+    i = bisect.bisect_left(timestamps, intanTimestamp)
+    if i == len(timestamps) or (i > 0 and intanTimestamp - timestamps[i - 1] <= timestamps[i] - intanTimestamp):
+        i -= 1
+    return segmentPath, entries[i]
+
+def readFrame(segmentPath, entry):
+    offset, length = entry[4], entry[5]
+    with open(segmentPath, 'rb') as segmentFile:
+        segmentFile.seek(offset)
+        return segmentFile.read(length)
+
 def readUint32(array, arrayIndex):
     variableBytes = array[arrayIndex : arrayIndex + 4]
     variable = int.from_bytes(variableBytes, byteorder='little', signed=False)
@@ -263,6 +510,8 @@ def ReadWaveformData(timestamps, data):
 
     # Read waveform data
     rawData = swaveform.recv(WAVEFORM_BUFFER_SIZE)
+    receivedWallClock = time.time()
+    lastTimestamp = None
 
     magicNumber = 0
     rawIndex = 0  # Index used to read the raw data that came in through the TCP socket
@@ -291,6 +540,7 @@ def ReadWaveformData(timestamps, data):
         # of these one-by-one
         for frame in range(framesPerBlock):
             if len(rawData) - rawIndex < 6:
+                publishIntanAnchor(lastTimestamp, receivedWallClock)
                 return
             
             # Expect 4 bytes to be timestamp as int32.
@@ -298,6 +548,7 @@ def ReadWaveformData(timestamps, data):
 
             # Multiply by 'timestep' to convert timestamp to seconds
             timestamps.append(rawTimestamp * timestep)
+            lastTimestamp = rawTimestamp
 
             # Expect 2 bytes of wideband data.
             rawSample, rawIndex = readUint16(rawData, rawIndex)
@@ -305,8 +556,12 @@ def ReadWaveformData(timestamps, data):
             # Scale this sample to convert to microVolts
             data.append(0.195 * (rawSample - 32768))
 
+    publishIntanAnchor(lastTimestamp, receivedWallClock)
+
 def main():
     global capture
+    global recorder
+    global cameraOutput
     capture = cv2.VideoCapture(1)
     global img
     global scommand
@@ -345,13 +600,26 @@ def main():
     selectChannel(b'a-000')
 
     plt.rcParams['figure.figsize'] = [9.6, 4.8]
+
+    if RECORD_VIDEO:
+        recorder = FrameRecorder(RECORD_DIRECTORY)
+        cameraOutput = CameraOutput()
+        captureThread = threading.Thread(target=captureFrames, daemon=True)
+        captureThread.start()
+        print('Recording camera frames to ' + recorder.directory)
     
     try:
         httpd = ThreadedHTTPServer(('', 8000), CamHandler)
         print("server started")
         httpd.serve_forever()
     except KeyboardInterrupt:
+        if cameraOutput is not None:
+            # Stop the capture thread before releasing the camera under it
+            captureStop.set()
+            captureThread.join()
         capture.release()
+        if recorder is not None:
+            recorder.close()
         httpd.socket.close()
 
 if __name__ == '__main__':
@@ -0,0 +1,101 @@
+import os
+import time
+
+import pytest
+
+import mjpegStream
+
+
+@pytest.fixture(autouse=True)
+def intanClock(monkeypatch):
+    monkeypatch.setattr(mjpegStream, 'timestep', 1 / 30000, raising=False)
+    monkeypatch.setattr(mjpegStream, 'intanAnchor', None)
+    monkeypatch.setattr(mjpegStream, 'intanOffsets', mjpegStream.collections.deque())
+    monkeypatch.setattr(mjpegStream, 'previousIntanTimestamp', None)
+
+
+def setIntanTime(wallClock, intanTimestamp):
+    mjpegStream.intanAnchor = (wallClock - intanTimestamp * mjpegStream.timestep, wallClock)
+
+
+def recordFrames(directory, count, segmentMaxBytes=mjpegStream.SEGMENT_MAX_BYTES):
+    recorder = mjpegStream.FrameRecorder(str(directory), segmentMaxBytes=segmentMaxBytes)
+    now = time.time()
+    setIntanTime(now, 1000)
+    for i in range(count):
+        recorder.write(b'\xff\xd8frame%d' % i, now + i / 30)
+    recorder.close()
+    return recorder.directory
+
+
+def test_index_round_trip(tmp_path):
+    session = recordFrames(tmp_path, 5)
+    segmentPath, entry = mjpegStream.findFrame(session, 1000 + 2000)
+    assert entry[0] == 2
+    assert mjpegStream.readFrame(segmentPath, entry) == b'\xff\xd8frame2'
+
+
+def test_segments_roll_over(tmp_path):
+    session = recordFrames(tmp_path, 5, segmentMaxBytes=25)
+    assert sorted(os.listdir(session)) == [
+        'segment_00000.idx', 'segment_00000.mjpg',
+        'segment_00001.idx', 'segment_00001.mjpg',
+    ]
+    segmentPath, entry = mjpegStream.findFrame(session, 1000 + 4000)
+    assert segmentPath.endswith('segment_00001.mjpg')
+    assert mjpegStream.readFrame(segmentPath, entry) == b'\xff\xd8frame4'
+
+
+def test_truncated_index_entry_is_dropped(tmp_path):
+    session = recordFrames(tmp_path, 3)
+    indexPath = os.path.join(session, 'segment_00000.idx')
+    with open(indexPath, 'ab') as indexFile:
+        indexFile.write(b'\x00' * 5)
+    assert len(mjpegStream.readIndex(indexPath)) == 3
+
+
+def test_unknown_timestamps_are_not_indexed(tmp_path):
+    recorder = mjpegStream.FrameRecorder(str(tmp_path))
+    now = time.time()
+    recorder.write(b'\xff\xd8unknown', now)
+    setIntanTime(now, -500)
+    recorder.write(b'\xff\xd8negative', now)
+    recorder.close()
+    segmentPath, entry = mjpegStream.findFrame(recorder.directory, -400)
+    assert mjpegStream.readFrame(segmentPath, entry) == b'\xff\xd8negative'
+
+
+def test_find_frame_without_timestamps_raises(tmp_path):
+    recorder = mjpegStream.FrameRecorder(str(tmp_path))
+    recorder.write(b'\xff\xd8unknown', time.time())
+    recorder.close()
+    with pytest.raises(ValueError):
+        mjpegStream.findFrame(recorder.directory, 0)
+
+
+def test_stale_anchor_gives_unknown_timestamp():
+    now = time.time()
+    setIntanTime(now - mjpegStream.INTAN_ANCHOR_MAX_AGE - 1, 1000)
+    assert mjpegStream.estimateIntanTimestamp(now) is None
+
+
+def test_anchor_uses_least_delayed_buffer():
+    now = time.time()
+    # The second buffer sat in the socket for 2 s before it was read
+    mjpegStream.publishIntanAnchor(30000, now)
+    mjpegStream.publishIntanAnchor(60000, now + 3)
+    assert mjpegStream.estimateIntanTimestamp(now + 3) == 120000
+
+
+def test_restart_starts_new_segment(tmp_path):
+    recorder = mjpegStream.FrameRecorder(str(tmp_path))
+    now = time.time()
+    setIntanTime(now, 90000)
+    recorder.write(b'\xff\xd8before', now)
+    setIntanTime(now, 100)
+    recorder.write(b'\xff\xd8after', now)
+    recorder.close()
+    sessionIndex = mjpegStream.readSessionIndex(recorder.directory)
+    assert [segment[1] for segment in sessionIndex] == [[90000], [100]]
+    segmentPath, entry = mjpegStream.findFrame(recorder.directory, 120, sessionIndex)
+    assert mjpegStream.readFrame(segmentPath, entry) == b'\xff\xd8after'